@@ -30,7 +30,25 @@ import sys
 import os
 import array
 import itertools
+import math
+import tarfile
+import zipfile
+import time
+import hashlib
+import sqlite3
+import mmap
+import json
+import resource
+import SocketServer
+import traceback
+import types
+import bisect
+from cStringIO import StringIO
 from operator import itemgetter
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 uint8_t  = ctypes.c_ubyte
 char     = ctypes.c_char
@@ -62,6 +80,107 @@ def get_struct(str_, off, struct):
 def DwordAt(f, off):
     return struct.unpack("<I", f[off:off+4])[0]
 
+def struct_codes(stype):
+    # struct module codes matching the fields of a packed ctypes structure; arrays become strings
+    codes = []
+    for name, ftype in stype._fields_:
+        if issubclass(ftype, ctypes.Array):
+            codes.append("%ds" % ctypes.sizeof(ftype))
+        else:
+            codes.append({1: "B", 2: "H", 4: "I", 8: "Q"}[ctypes.sizeof(ftype)])
+    assert struct.calcsize("<" + "".join(codes)) == ctypes.sizeof(stype)
+    return codes
+
+class DirOutput:
+    # extracted files go into a directory tree under the current directory
+    def __init__(self):
+        self.path = []
+        self.written = set()
+
+    def enter(self, nm):
+        try:
+           os.mkdir(nm)
+        except:
+           pass
+        os.chdir(nm)
+        self.path.append(nm)
+
+    def leave(self):
+        os.chdir("..")
+        self.path.pop()
+
+    def write(self, fname, data, offset=None):
+        open(fname, "wb").write(data)
+        self.written.add("/".join(self.path + [fname]))
+
+    def close(self):
+        pass
+
+class ArchiveOutput:
+    # extracted files become members of a single tar or zip stream
+    # fname "-" streams a tar to stdout; an INDEX member is appended on close
+    def __init__(self, fname, compress):
+        self.path = []
+        self.index = []
+        self.names = set()
+        self.tar = None
+        self.zip = None
+        if fname.endswith(".zip"):
+            ctype = [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED][compress]
+            self.zip = zipfile.ZipFile(fname, "w", ctype, allowZip64=True)
+        else:
+            mode = "w|" + ["", "gz"][compress]
+            if fname == "-":
+                self.tar = tarfile.open(fileobj=sys.stdout, mode=mode)
+            else:
+                self.tar = tarfile.open(fname, mode)
+
+    def enter(self, nm):
+        self.path.append(nm)
+
+    def leave(self):
+        self.path.pop()
+
+    def add(self, name, data):
+        if self.zip:
+            self.zip.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0644
+            self.tar.addfile(info, StringIO(data))
+
+    def write(self, fname, data, offset=None):
+        name = "/".join(self.path + [fname])
+        # shared files (e.g. the Huffman table of a multi-module partition) are
+        # written once per module; on disk they just overwrite, keep one member
+        if name in self.names:
+            return
+        self.names.add(name)
+        self.add(name, data)
+        self.index.append((offset, len(data), name))
+
+    def close(self):
+        lines = []
+        for offset, size, name in self.index:
+            if offset is None:
+                soff = "--------"
+            else:
+                soff = "%08X" % offset
+            lines.append("%s %08X %s\n" % (soff, size, name))
+        self.add("INDEX", "".join(lines))
+        if self.zip:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+output = DirOutput()
+meta = None
+known = None
+blockmap = None
+incr = None
+
 class MeModuleHeader1(ctypes.LittleEndianStructure):
     _fields_ = [
         ("Tag",            char*4),   # $MME
@@ -81,9 +200,13 @@ class MeModuleHeader1(ctypes.LittleEndianStructure):
     def __init__(self):
         self.Offset = None
 
-    def comptype(self):
+    @staticmethod
+    def flags_comptype(flags):
         return COMP_TYPE_NOT_COMPRESSED
 
+    def comptype(self):
+        return self.flags_comptype(self.Flags)
+
     def print_flags(self):
         print "    Disable Hash:   %d" % ((self.Flags>>0)&1)
         print "    Optional:       %d" % ((self.Flags>>1)&1)
@@ -181,8 +304,12 @@ class MeModuleHeader2(ctypes.LittleEndianStructure):
         ("Unk5C",          uint32_t), #
     ]
 
+    @staticmethod
+    def flags_comptype(flags):
+        return (flags>>4)&7
+
     def comptype(self):
-        return (self.Flags>>4)&7
+        return self.flags_comptype(self.Flags)
 
     def print_flags(self):
         print "    Unknown B0:     %d" % ((self.Flags>>0)&1)
@@ -227,18 +354,123 @@ class MeModuleHeader2(ctypes.LittleEndianStructure):
         print "Unk5C:          0x%08X" % (self.Unk5C)
 
 
+class ModuleTable(object):
+    # a manifest's module header array, decoded column by column with a single
+    # struct.unpack; ctypes header objects are only built when indexed, printing
+    # goes through ModuleRow views of the columns
+    __slots__ = ["htype", "f", "offset", "cols", "bytecols", "names", "sizes", "offsets", "comptypes", "known", "uncomp"]
+
+    def __init__(self, htype, f, offset, count):
+        self.htype = htype
+        self.f = f
+        self.offset = offset
+        codes = struct_codes(htype)
+        hdrlen = ctypes.sizeof(htype)
+        data = f[offset:offset+count*hdrlen].ljust(count*hdrlen, '\0')
+        vals = struct.unpack("<" + "".join(codes)*count, data)
+        nfields = len(codes)
+        self.cols = {}
+        self.bytecols = set()
+        for i in range(nfields):
+            name, ftype = htype._fields_[i]
+            col = vals[i::nfields]
+            if not codes[i].endswith("s"):
+                col = array.array(codes[i], col)
+            elif ftype._type_ is not char:
+                self.bytecols.add(name)
+            self.cols[name] = col
+        self.names = [nm.split('\0', 1)[0] for nm in self.cols["Name"]]
+        self.sizes = self.cols["Size"]
+        if "Offset" in self.cols:
+            self.offsets = list(self.cols["Offset"])
+        else:
+            self.offsets = [None] * count
+        self.comptypes = [htype.flags_comptype(fl) for fl in self.cols["Flags"]]
+        self.known = [False] * count
+        self.uncomp = [None] * count
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if i >= len(self.names):
+            raise IndexError(i)
+        mod = get_struct(self.f, self.offset + i*ctypes.sizeof(self.htype), self.htype)
+        mod.Offset = self.offsets[i]
+        mod.UncompressedSize = self.uncomp[i]
+        mod.Known = self.known[i]
+        return mod
+
+    def row(self, i):
+        return ModuleRow(self, i)
+
+class ModuleRow(object):
+    # attribute view of one ModuleTable entry that behaves like the header
+    # structure for its pprint/print_flags/comptype methods
+    __slots__ = ["table", "i"]
+
+    def __init__(self, table, i):
+        self.table = table
+        self.i = i
+
+    def __getattr__(self, name):
+        table, i = self.table, self.i
+        if name == "Offset":
+            return table.offsets[i]
+        if name == "UncompressedSize":
+            return table.uncomp[i]
+        if name == "Known":
+            return table.known[i]
+        if name in table.cols:
+            val = table.cols[name][i]
+            if name in table.bytecols:
+                return bytearray(val)
+            if isinstance(val, str):
+                # as ctypes returns char arrays
+                return val.split('\0', 1)[0]
+            return val
+        return types.MethodType(getattr(table.htype, name).im_func, self)
+
 def extract_code_mods(nm, f, soff):
-    try:
-       os.mkdir(nm)
-    except:
-       pass
-    os.chdir(nm)
+    output.enter(nm)
     print " extracting CODE partition %s" % (nm)
     manif = get_struct(f, soff, MeManifestHeader)
     manif.parse_mods(f, soff)
     manif.pprint()
     manif.extract(f, soff)
-    os.chdir("..")
+    output.leave()
+
+def has_manifest(f, soff):
+    return f[soff+0x1C:soff+0x20] in ['$MN2', '$MAN']
+
+def parse_code_mods(nm, f, soff):
+    # same walk as extract_code_mods, including update parts, but writes nothing;
+    # a bad partition is reported and recorded without losing the rest of the image
+    if not has_manifest(f, soff):
+        print " CODE partition %s has no manifest (skipping)" % (nm)
+        if meta:
+            meta.add_error(soff, nm, "no manifest")
+        return
+    print " parsing CODE partition %s" % (nm)
+    try:
+        manif = get_struct(f, soff, MeManifestHeader)
+        manif.parse_mods(f, soff)
+        manif.pprint()
+    except Exception, e:
+        print "Error parsing CODE partition %s: %s" % (nm, e)
+        if meta:
+            meta.add_error(soff, nm, str(e))
+        return
+    for subtag, subsoff, subsize in manif.updparts:
+        print "Update part: %r %08X/%08X" % (subtag, subsoff, subsize),
+        if is_padding(subsoff, subsize):
+            print " (empty)"
+        elif is_unchanged(subsoff, subsize):
+            print " (unchanged)"
+            incr.reuse_meta(subsoff, subsize)
+        else:
+            print
+            parse_code_mods(subtag, f, subsoff)
 
 class HuffmanOffsetBytes(ctypes.LittleEndianStructure):
     _fields_ = [
@@ -279,7 +511,6 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
     ]
 
     def parse_mods(self, f, offset):
-        self.modules = []
         self.updparts = []
         orig_off = offset
         offset += self.HeaderLen*4
@@ -297,20 +528,19 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
         else:
             raise Exception("Don't know how to parse modules for manifest tag %s!" % self.Tag)
 
-        modmap = {}
+        mods = ModuleTable(htype, f, offset, self.NumModules)
+        self.modules = mods
+        modmap = dict(zip(mods.names, range(len(mods))))
         self.huff_start = 0
-        for i in range(self.NumModules):
-            mod = get_struct(f, offset, htype)
-            if not [mod.Tag in '$MME', '$MDL']:
-                raise Exception("Bad module tag (%s) at offset %08X!" % (mod.Tag, offset))
-            nm = mod.Name.rstrip('\0')
-            modmap[nm] = mod
-            self.modules.append(mod)
-            if mod.comptype() == COMP_TYPE_HUFFMAN:
-                if self.huff_start and self.huff_start != orig_off + mod.Offset:
+        for i in range(len(mods)):
+            if mods.comptypes[i] == COMP_TYPE_HUFFMAN:
+                if self.huff_start and self.huff_start != orig_off + mods.offsets[i]:
                     print "Warning: inconsistent start offset for Huffman modules!"
-                self.huff_start = orig_off + mod.Offset
-            offset += hdrlen
+                self.huff_start = orig_off + mods.offsets[i]
+        if known != None:
+            mods.known = [h in known for h in mods.cols["Hash"]]
+            print "Known modules: %d of %d" % (sum(mods.known), len(mods))
+        offset += hdrlen * len(mods)
 
         self.partition_end = None
         hdr_end = orig_off + self.Size*4
@@ -319,6 +549,11 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
             hdr = f[offset:offset+8]
             if hdr == '\xFF' * 8:
                 offset += hdrlen
+                if blockmap:
+                    # hop over whole 0xFF blocks in hdrlen steps so the walk stays aligned
+                    ffend = min(blockmap.ff_end(offset), hdr_end)
+                    if ffend - 8 >= offset:
+                        offset += ((ffend - 8 - offset) // hdrlen + 1) * hdrlen
                 continue
             if len(hdr) < 8 or hdr[0] != '$':
                 break
@@ -352,10 +587,10 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
             mfhdr = get_struct(f, offset, MeModuleFileHeader1)
             mfhdr.pprint()
             nm = mfhdr.Name.rstrip('\0')
-            mod = modmap[nm]
-            mod.Offset = offset - orig_off
-            mod.UncompressedSize = mfhdr.UncompressedSize
-            offset += mod.Size
+            i = modmap[nm]
+            mods.offsets[i] = offset - orig_off
+            mods.uncomp[i] = mfhdr.UncompressedSize
+            offset += mods.sizes[i]
         
         # check for huffman LUT
         offset = self.huff_start
@@ -370,29 +605,41 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
         else:
             self.huff_start = 0xFFFFFFFF
             self.huff_end = 0xFFFFFFFF
+        if meta:
+            meta.add_manifest(self, orig_off)
 
     def extract(self, f, offset):
         huff_end = self.huff_end
         nhuffs = 0
-        for mod in self.modules:
-            if mod.comptype() != COMP_TYPE_HUFFMAN:
-                huff_end = min(huff_end, mod.Offset)
+        huff_known = True
+        mods = self.modules
+        for imod in range(len(mods)):
+            if mods.comptypes[imod] != COMP_TYPE_HUFFMAN:
+                huff_end = min(huff_end, mods.offsets[imod])
             else:
-                print "Huffman module data:  %r %08X/%08X" % (mod.Name.rstrip('\0'), self.datastart, self.datalen)
+                print "Huffman module data:  %r %08X/%08X" % (mods.names[imod], self.datastart, self.datalen)
                 nhuffs += 1
-        for imod in range(len(self.modules)):
-            mod = self.modules[imod]
-            nm = mod.Name.rstrip('\0')
-            islast = (imod == len(self.modules)-1)
-            print "Module:      %r %08X" % (nm, mod.Size),
-            if mod.Offset in [0xFFFFFFFF, 0] or (mod.Size in [0xFFFFFFFF, 0] and not islast and mod.comptype() != COMP_TYPE_HUFFMAN):
+                huff_known = huff_known and mods.known[imod]
+        for imod in range(len(mods)):
+            nm = mods.names[imod]
+            modoff, modsize, comptype = mods.offsets[imod], mods.sizes[imod], mods.comptypes[imod]
+            islast = (imod == len(mods)-1)
+            print "Module:      %r %08X" % (nm, modsize),
+            if modoff in [0xFFFFFFFF, 0] or (modsize in [0xFFFFFFFF, 0] and not islast and comptype != COMP_TYPE_HUFFMAN):
                 print " (skipping)"
+            elif mods.known[imod]:
+                print " (known)"
+            elif comptype != COMP_TYPE_HUFFMAN and is_padding(offset + modoff, modsize):
+                print " (empty)"
+            elif incr and incr.module_unchanged(offset, nm, modoff, modsize, self.mod_ranges(offset, imod),
+                    (comptype == COMP_TYPE_HUFFMAN and nhuffs != 1) and self.PartitionName or nm):
+                print " (unchanged)"
             else:
-                soff = offset + mod.Offset
-                size = mod.Size
-                if mod.comptype() == COMP_TYPE_LZMA:
+                soff = offset + modoff
+                size = modsize
+                if comptype == COMP_TYPE_LZMA:
                     ext = "lzma"
-                elif mod.comptype() == COMP_TYPE_HUFFMAN:
+                elif comptype == COMP_TYPE_HUFFMAN:
                     if nhuffs != 1:
                         nm = self.PartitionName
 
@@ -401,7 +648,7 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
 		    ext = "huffoff"
                     fnametab = "%s_mod.%s" % (nm, ext)
                     print " => %s" % (fnametab),
-                    open(fnametab, "wb").write(f[soff:soff+size])
+                    output.write(fnametab, f[soff:soff+size], soff)
 
                     #ext = "huff"
 		    #soff = self.huff_start
@@ -416,23 +663,30 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
                     ext = "mod"
                     moff = soff+0x50
                     if f[moff:moff+5] == '\x5D\x00\x00\x80\x00':
-                        lzf = open("%s_mod.lzma" % nm, "wb")
-                        lzf.write(f[moff:moff+5])
-                        lzf.write(struct.pack("<Q", mod.UncompressedSize))
-                        lzf.write(f[moff+5:moff+mod.Size-0x50])
+                        lzdata = f[moff:moff+5] + struct.pack("<Q", mods.uncomp[imod]) + f[moff+5:moff+modsize-0x50]
+                        output.write("%s_mod.lzma" % nm, lzdata, moff)
                 fnamemod = "%s_mod.%s" % (nm, ext)
                 print " => %s" % (fnamemod)
-                open(fnamemod, "wb").write(f[soff:soff+size])
+                output.write(fnamemod, f[soff:soff+size], soff)
         for subtag, soff, subsize in self.updparts:
             fname = "%s_udc.bin" % subtag
             print "Update part: %r %08X/%08X" % (subtag, soff, subsize),
+            if is_padding(soff, subsize):
+                print " (empty)"
+                continue
+            if incr and incr.reuse([(soff, subsize)], [fname, subtag + "/"]):
+                print " (unchanged)"
+                incr.reuse_meta(soff, subsize)
+                continue
             print " => %s" % (fname)
-            open(fname, "wb").write(f[soff:soff+subsize])
+            output.write(fname, f[soff:soff+subsize], soff)
             extract_code_mods(subtag, f, soff)
 
         # Huffman chunks
-	fhufftab = open("%s_mod.huffchunksummary" % self.PartitionName, "w")
-	fhufftab.write("Huffman chunks:\n")
+        if nhuffs and huff_known:
+            print "Huffman chunks: all Huffman modules known (skipping)"
+            return
+        hufftab = ["Huffman chunks:\n"]
         chunksize = self.chunksize
 
         huffmanoffsets = []
@@ -442,8 +696,8 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
             huffmanoffsets[huffoff][1] = (huffmanoffsets[huffoff][0] >> 24) & 0xFF
             huffmanoffsets[huffoff][0] = huffmanoffsets[huffoff][0] & 0xFFFFFF
             print "0x%04X 0x%02X    (0x%06X)"  % (huffoff, huffmanoffsets[huffoff][1], huffmanoffsets[huffoff][0])
-            fhufftab.write("0x%04X 0x%02X    (0x%06X) 0x%04X\n"  % (huffoff, huffmanoffsets[huffoff][1], huffmanoffsets[huffoff][0], huffmanoffsets[huffoff][0] - huffmanoffsets[huffoff-1][0]))
-        fhufftab.close()
+            hufftab.append("0x%04X 0x%02X    (0x%06X) 0x%04X\n"  % (huffoff, huffmanoffsets[huffoff][1], huffmanoffsets[huffoff][0], huffmanoffsets[huffoff][0] - huffmanoffsets[huffoff-1][0]))
+        output.write("%s_mod.huffchunksummary" % self.PartitionName, "".join(hufftab))
         huffmanoffsets.append([self.datastart, 0x00])
         huffmanoffsets = sorted(huffmanoffsets, key=itemgetter(0))
         for huffoff in range(self.chunkcount):
@@ -452,7 +706,18 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
                 offset0 = huffmanoffsets[huffoff][0]
                 offset1 = huffmanoffsets[huffoff+1][0]
                 chunklen = offset1 - offset0
-		open("%s_chunk_%02X_%04d.huff" % (self.PartitionName, flag, huffoff), "wb").write(f[offset0:offset1])
+                if is_padding(offset0, chunklen):
+                    continue
+                fname = "%s_chunk_%02X_%04d.huff" % (self.PartitionName, flag, huffoff)
+                if incr and incr.reuse([(offset0, chunklen), (self.huff_start + 0x40, self.chunkcount*4)], [fname]):
+                    continue
+                output.write(fname, f[offset0:offset1], offset0)
+
+    def mod_ranges(self, offset, imod):
+        # image ranges the files of a module are cut from
+        if self.modules.comptypes[imod] == COMP_TYPE_HUFFMAN:
+            return [(self.huff_start + 0x40, self.chunkcount*4), (self.datastart, self.datalen)]
+        return [(offset + self.modules.offsets[imod], self.modules.sizes[imod])]
 
     def pprint(self):
         print "Module Type: %d, Subtype: %d" % (self.ModuleType, self.ModuleSubType)
@@ -477,8 +742,8 @@ class MeManifestHeader(ctypes.LittleEndianStructure):
             pname = "(none)"
         print "Partition name:      %s" % (pname)
         print "---Modules---"
-        for mod in self.modules:
-            mod.pprint()
+        for imod in range(len(self.modules)):
+            self.modules.row(imod).pprint()
             print
         print "------End-------"
 
@@ -545,6 +810,7 @@ class MeFptTable:
             base = offset
         else:
             raise Exception("FPT format not recognized")
+        orig_off = offset
         num_entries = DwordAt(f, base+4)
         self.BCDVer, self.FPTEntryType, self.HeaderLen, self.Checksum = struct.unpack("<BBBB", f[base+8:base+12])
         self.FlashCycleLifetime, self.FlashCycleLimit, self.UMASize   = struct.unpack("<HHI", f[base+12:base+20])
@@ -555,6 +821,26 @@ class MeFptTable:
             part = get_struct(f, offset, MeFptEntry) #MeFptEntry(f, offset)
             offset += 0x20
             self.parts.append(part)
+        if meta:
+            meta.add_fpt(self, orig_off)
+
+    def parse_code(self, f, offset):
+        # parse the CODE partition manifests without extracting anything
+        for ipart in range(len(self.parts)):
+            part = self.parts[ipart]
+            islast = (ipart == len(self.parts)-1)
+            if part.Offset in [0xFFFFFFFF, 0] or (part.Size in [0xFFFFFFFF, 0] and not islast):
+                continue
+            if part.ptype() == PT_CODE:
+                soff = offset + part.Offset
+                if is_padding(soff, part.Size):
+                    print " CODE partition %s empty" % (part.Name.rstrip('\0'))
+                    continue
+                if is_unchanged(soff, part.Size):
+                    print " CODE partition %s unchanged" % (part.Name.rstrip('\0'))
+                    incr.reuse_meta(soff, part.Size)
+                    continue
+                parse_code_mods(part.Name.rstrip('\0'), f, soff)
 
     def extract(self, f, offset):
         for ipart in range(len(self.parts)):
@@ -563,13 +849,17 @@ class MeFptTable:
             islast = (ipart == len(self.parts)-1)
             if part.Offset in [0xFFFFFFFF, 0] or (part.Size in [0xFFFFFFFF, 0] and not islast):
                 print " (skipping)"
+            elif is_padding(offset + part.Offset, part.Size):
+                print " (empty)"
+            elif incr and incr.reuse([(offset + part.Offset, part.Size)], [part_fname(part), part.Name.rstrip('\0') + "/"]):
+                print " (unchanged)"
+                incr.reuse_meta(offset + part.Offset, part.Size)
             else:
                 nm = part.Name.rstrip('\0')
                 soff  = offset + part.Offset
-                fname = "%s_part.bin" % (part.Name)
-                fname = replace_bad(fname, map(chr, range(128, 256) + range(0, 32)))
+                fname = part_fname(part)
                 print " => %s" % (fname)
-                open(fname, "wb").write(f[soff:soff+part.Size])
+                output.write(fname, f[soff:soff+part.Size], soff)
                 if part.ptype() == PT_CODE:
                     extract_code_mods(nm, f, soff)
 
@@ -607,6 +897,10 @@ def print_flreg(val, name):
     print "  %08X - %08X (0x%08X bytes)" % (base, lim, lim - base + 1)
     return (base, lim)
 
+def part_fname(part):
+    fname = "%s_part.bin" % (part.Name)
+    return replace_bad(fname, map(chr, range(128, 256) + range(0, 32)))
+
 def parse_descr(f, offset, extract):
     mapoff = offset
     if f[offset+0x10:offset+0x14] == "\x5A\xA5\xF0\x0F":
@@ -629,12 +923,18 @@ def parse_descr(f, offset, extract):
         r = print_flreg(FLREG, region_names[i])
         if r:
             base, lim = r
+            if meta:
+                meta.add_region(i, offset + base, lim - base + 1)
             if i == 2:
                 me_offset = offset + base
-            if extract:
+            if extract and is_padding(offset + base, lim + 1):
+                print " (empty)"
+            elif extract and incr and incr.reuse([(offset + base, lim + 1)], ["%s.bin" % region_fnames[i]]):
+                print " (unchanged)"
+            elif extract:
                 fname = "%s.bin" % region_fnames[i]
                 print " => %s" % (fname)
-                open(fname, "wb").write(f[offset + base:offset + base + lim + 1])
+                output.write(fname, f[offset + base:offset + base + lim + 1], offset + base)
     return me_offset
 
 class AcManifestHeader(ctypes.LittleEndianStructure):
@@ -688,49 +988,645 @@ class AcManifestHeader(ctypes.LittleEndianStructure):
         print "RSA Signature:       [skipped]"
         print "------End-------"
 
-print "Intel ME dumper/extractor v0.1"
-if len(sys.argv) < 2:
-    print "Usage: dump_me.py MeImage.bin [-x] [offset]"
+class BlockMap:
+    # per-block view of the image: 0xFF padding, 0x00 padding or data,
+    # with the Shannon entropy (bits per byte) of each data block
+    BLK_FF   = "F"
+    BLK_ZERO = "0"
+    BLK_DATA = "D"
+    KIND_NAMES = {"F": "0xFF", "0": "0x00", "D": "data"}
+
+    def __init__(self, f, blocksize=0x1000):
+        self.f = f
+        self.blocksize = blocksize
+        ff = '\xFF' * blocksize
+        zero = '\0' * blocksize
+        kinds = []
+        for off in xrange(0, len(f), blocksize):
+            n = min(blocksize, len(f) - off)
+            if f.startswith(ff[:n], off):
+                kinds.append(self.BLK_FF)
+            elif f.startswith(zero[:n], off):
+                kinds.append(self.BLK_ZERO)
+            else:
+                kinds.append(self.BLK_DATA)
+        self.kinds = "".join(kinds)
+        self.entropy = None
+
+    def calc_entropy(self):
+        bs = self.blocksize
+        f = self.f
+        self.entropy = [0.0] * len(self.kinds)
+        data = [i for i in xrange(len(self.kinds)) if self.kinds[i] == self.BLK_DATA]
+        full = len(f) // bs
+        if numpy:
+            # histogram many blocks at once: row i's bytes land in bins [i*256, i*256+256)
+            idx = numpy.array([i for i in data if i < full], dtype=numpy.intp)
+            blocks = numpy.frombuffer(f, numpy.uint8, full * bs).reshape(full, bs)
+            for start in xrange(0, len(idx), 256):
+                rows = idx[start:start+256]
+                bins = blocks[rows].astype(numpy.intp) + (numpy.arange(len(rows)) * 256)[:, None]
+                counts = numpy.bincount(bins.ravel(), minlength=len(rows)*256).reshape(len(rows), 256)
+                p = counts / float(bs)
+                h = -(p * numpy.log2(numpy.where(p > 0, p, 1))).sum(axis=1)
+                for i, v in zip(rows, h):
+                    self.entropy[i] = float(v)
+            data = [i for i in data if i >= full]
+        for i in data:
+            blk = f[i*bs:(i+1)*bs]
+            n = float(len(blk))
+            self.entropy[i] = -sum(c/n * math.log(c/n, 2) for c in [blk.count(b) for b in set(blk)])
+
+    def is_padding(self, off, size):
+        # True if every byte of f[off:off+size] is 0xFF or 0x00 padding;
+        # ranges running past the end are cut short, as the file slices are
+        size = min(size, len(self.f) - off)
+        if size <= 0 or off < 0:
+            return False
+        bs = self.blocksize
+        first = (off + bs - 1) // bs
+        last = (off + size) // bs
+        if first >= last:
+            return self.f[off:off+size].strip('\xFF\0') == ''
+        if self.BLK_DATA in self.kinds[first:last]:
+            return False
+        return (self.f[off:first*bs].strip('\xFF\0') == '' and
+                self.f[last*bs:off+size].strip('\xFF\0') == '')
+
+    def ff_end(self, off):
+        # end of the 0xFF block run containing off, or off if it is not in one
+        i = off // self.blocksize
+        while i < len(self.kinds) and self.kinds[i] == self.BLK_FF:
+            i += 1
+        return max(off, i * self.blocksize)
+
+    def runs(self):
+        if self.entropy == None:
+            self.calc_entropy()
+        bs = self.blocksize
+        for kind, grp in itertools.groupby(enumerate(self.kinds), itemgetter(1)):
+            blocks = [i for i, k in grp]
+            ent = [self.entropy[i] for i in blocks]
+            start = blocks[0] * bs
+            end = min(len(self.f), (blocks[-1] + 1) * bs)
+            yield start, end - start, kind, sum(ent) / len(ent), max(ent)
+
+    def pprint(self):
+        print "===Flash Layout (0x%X byte blocks)===" % self.blocksize
+        for start, size, kind, avgent, maxent in self.runs():
+            print "%08X - %08X (0x%08X bytes) %-4s" % (start, start + size - 1, size, self.KIND_NAMES[kind]),
+            if kind == self.BLK_DATA:
+                print " entropy avg %.2f max %.2f" % (avgent, maxent)
+            else:
+                print
+        nblocks = max(len(self.kinds), 1)
+        print "Padding: %d%% 0xFF, %d%% 0x00" % (self.kinds.count(self.BLK_FF)*100 // nblocks, self.kinds.count(self.BLK_ZERO)*100 // nblocks)
+        print "------End-------"
+
+def is_padding(off, size):
+    return blockmap != None and blockmap.is_padding(off, size)
+
+class Incremental:
+    # per-block SHA-1 hashes of the image are kept in a state file together with
+    # the manifest and module rows; on the next dump of the same flash only the
+    # partitions and modules overlapping changed blocks are parsed and written,
+    # the rest keep their files from the previous run and their saved rows
+    def __init__(self, statename, f, options, outdir, blocksize=0x1000):
+        self.statename = statename
+        self.options = options
+        self.outdir = outdir
+        self.size = len(f)
+        self.blocksize = blocksize
+        self.hashes = [hashlib.sha1(buffer(f, off, blocksize)).hexdigest() for off in xrange(0, len(f), blocksize)]
+        self.changed = None
+        self.prev_manifests = []
+        self.prev_modules = []
+        self.prev_modmap = {}
+        self.prev_files = set()
+        self.kept = set()
+        try:
+            state = json.load(open(statename))
+            if (state["size"], state["blocksize"], state["options"], state["outdir"]) != (self.size, blocksize, options, outdir):
+                print "Incremental: image size, options or output directory differ from %s, full run" % statename
+                return
+            changed = [i for i in range(len(self.hashes)) if self.hashes[i] != state["blocks"][i]]
+            prev_manifests, prev_modules, prev_files = state["manifests"], state["modules"], state["files"]
+        except (IOError, ValueError, KeyError, IndexError):
+            print "Incremental: no usable previous state in %s, full run" % statename
+            return
+        # unchanged parts are not rewritten, so the earlier files must still be there
+        for name in prev_files:
+            if not os.path.exists(os.path.join(outdir, name)):
+                print "Incremental: %s from the previous run is missing, full run" % name
+                return
+        self.changed = changed
+        self.prev_manifests = prev_manifests
+        self.prev_modules = prev_modules
+        self.prev_files = set(prev_files)
+        for row in self.prev_modules:
+            self.prev_modmap[(row["manifest_offset"], row["name"])] = row
+        print "Incremental: %d of %d blocks changed" % (len(self.changed), len(self.hashes))
+
+    def unchanged(self, off, size):
+        # ranges running past the end are cut short, as the file slices are
+        size = min(size, self.size - off)
+        if self.changed == None or size <= 0 or off < 0:
+            return False
+        first = off // self.blocksize
+        last = (off + size - 1) // self.blocksize
+        i = bisect.bisect_left(self.changed, first)
+        return i == len(self.changed) or self.changed[i] > last
+
+    def module_unchanged(self, manif_off, nm, modoff, modsize, ranges, fnm):
+        # the module must also have been at the same place under the same name last time
+        row = self.prev_modmap.get((manif_off, dbstr(nm)))
+        if row == None or row["size"] != modsize or row["offset"] != manif_off + modoff:
+            return False
+        return self.reuse(ranges, [fnm + "_mod."])
+
+    def reuse(self, ranges, names):
+        # a part is only left alone if its ranges are unchanged and the previous
+        # run wrote its file (first name) under the same name; the files under
+        # all the name prefixes are then carried over to the new state
+        for off, size in ranges:
+            if not self.unchanged(off, size):
+                return False
+        prefixes = ["/".join(output.path + [nm]) for nm in names]
+        files = [name for name in self.prev_files if name.startswith(prefixes[0])]
+        if not files:
+            return False
+        for prefix in prefixes[1:]:
+            files += [name for name in self.prev_files if name.startswith(prefix)]
+        self.kept.update(files)
+        return True
+
+    def reuse_meta(self, off, size):
+        for row in self.prev_manifests:
+            if off <= row["offset"] < off + size:
+                meta.manifests.append(row)
+        for row in self.prev_modules:
+            if off <= row["manifest_offset"] < off + size:
+                meta.modules.append(row)
+
+    def save(self, meta, written):
+        # files of the previous run that were neither reused nor rewritten are
+        # stale: their part is gone, renamed, empty or known now
+        files = self.kept | written
+        for name in self.prev_files - files:
+            try:
+                os.remove(os.path.join(self.outdir, name))
+            except OSError:
+                pass
+        files = sorted(files)
+        state = dict(size=self.size, blocksize=self.blocksize, options=self.options, outdir=self.outdir,
+            blocks=self.hashes, files=files, manifests=meta.manifests, modules=meta.modules)
+        json.dump(state, open(self.statename, "w"))
+
+def is_unchanged(off, size):
+    return incr != None and incr.unchanged(off, size)
+
+def hexstr(v):
+    return v.encode("hex").upper()
+
+def dbstr(v):
+    # names come straight from the image and may hold any byte value
+    return v.rstrip('\0').decode("latin-1")
+
+class ImageMeta:
+    # metadata collected while parsing an image, one list of rows per table
+    def __init__(self):
+        self.regions = []
+        self.fpts = []
+        self.partitions = []
+        self.manifests = []
+        self.modules = []
+        self.layout = []
+        self.errors = []
+
+    def add_region(self, idx, base, size):
+        self.regions.append(dict(idx=idx, name=region_names[idx], base=base, size=size))
+
+    def add_fpt(self, fpt, offset):
+        self.fpts.append(dict(offset=offset, version="%d.%d" % (fpt.BCDVer >> 4, fpt.BCDVer & 0xF),
+            entry_type=fpt.FPTEntryType, header_len=fpt.HeaderLen, checksum=fpt.Checksum,
+            flash_cycle_lifetime=fpt.FlashCycleLifetime, flash_cycle_limit=fpt.FlashCycleLimit,
+            uma_size=fpt.UMASize, flags=fpt.Flags, effs_present=fpt.Flags&1, layout_type=(fpt.Flags>>1)&0xFF,
+            num_parts=len(fpt.parts)))
+        for ipart in range(len(fpt.parts)):
+            part = fpt.parts[ipart]
+            owner = None
+            if part.Owner != '\xFF\xFF\xFF\xFF':
+                owner = dbstr(part.Owner)
+            self.partitions.append(dict(fpt_offset=offset, idx=ipart, name=dbstr(part.Name), owner=owner,
+                offset=offset + part.Offset, size=part.Size, ptype=part.ptype(),
+                tokens_on_start=part.TokensOnStart, max_tokens=part.MaxTokens,
+                scratch_sectors=part.ScratchSectors, flags=part.Flags))
+
+    def add_error(self, offset, name, error):
+        self.errors.append(dict(offset=offset, name=dbstr(name), error=error.decode("latin-1")))
+
+    def add_layout(self, blockmap):
+        for start, size, kind, avgent, maxent in blockmap.runs():
+            self.layout.append(dict(offset=start, size=size, kind=BlockMap.KIND_NAMES[kind],
+                entropy_avg=round(avgent, 3), entropy_max=round(maxent, 3)))
+
+    def add_manifest(self, manif, offset):
+        self.manifests.append(dict(offset=offset, tag=manif.Tag, module_type=manif.ModuleType,
+            module_subtype=manif.ModuleSubType, header_version="%d.%d" % (manif.HeaderVersion>>16, manif.HeaderVersion&0xFFFF),
+            flags=manif.Flags, debug=(manif.Flags>>31)&1, preproduction=(manif.Flags>>30)&1,
+            vendor=manif.ModuleVendor, date="%08X" % manif.Date, size=manif.Size*4, num_modules=manif.NumModules,
+            major=manif.MajorVersion, minor=manif.MinorVersion, hotfix=manif.HotfixVersion, build=manif.BuildVersion,
+            version="%d.%d.%d.%d" % (manif.MajorVersion, manif.MinorVersion, manif.HotfixVersion, manif.BuildVersion),
+            partition_name=dbstr(manif.PartitionName)))
+        mods = manif.modules
+        cols = mods.cols
+        for imod in range(len(mods)):
+            row = dict(manifest_offset=offset, idx=imod, name=dbstr(mods.names[imod]), hash=hexstr(cols["Hash"][imod]),
+                offset=None, size=mods.sizes[imod], flags=cols["Flags"][imod], comptype=mods.comptypes[imod],
+                guid=None, version=None, load_base=None)
+            if mods.offsets[imod] != None:
+                row["offset"] = offset + mods.offsets[imod]
+            if "Guid" in cols:
+                row["guid"] = hexstr(cols["Guid"][imod])
+                row["version"] = "%d.%d.%d.%d" % (cols["MajorVersion"][imod], cols["MinorVersion"][imod],
+                    cols["HotfixVersion"][imod], cols["BuildVersion"][imod])
+            if "LoadBase" in cols:
+                row["load_base"] = cols["LoadBase"][imod]
+            self.modules.append(row)
+
+meta_schema = """
+CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, path TEXT, sha1 TEXT UNIQUE, size INTEGER, added INTEGER);
+CREATE TABLE IF NOT EXISTS image_paths (image_id INTEGER, path TEXT, added INTEGER, UNIQUE (image_id, path));
+CREATE TABLE IF NOT EXISTS regions (image_id INTEGER, idx INTEGER, name TEXT, base INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS fpts (image_id INTEGER, offset INTEGER, version TEXT, entry_type INTEGER, header_len INTEGER,
+    checksum INTEGER, flash_cycle_lifetime INTEGER, flash_cycle_limit INTEGER, uma_size INTEGER, flags INTEGER,
+    effs_present INTEGER, layout_type INTEGER, num_parts INTEGER);
+CREATE TABLE IF NOT EXISTS partitions (image_id INTEGER, fpt_offset INTEGER, idx INTEGER, name TEXT, owner TEXT,
+    offset INTEGER, size INTEGER, ptype INTEGER, tokens_on_start INTEGER, max_tokens INTEGER, scratch_sectors INTEGER,
+    flags INTEGER);
+CREATE TABLE IF NOT EXISTS manifests (image_id INTEGER, offset INTEGER, tag TEXT, module_type INTEGER,
+    module_subtype INTEGER, header_version TEXT, flags INTEGER, debug INTEGER, preproduction INTEGER, vendor INTEGER,
+    date TEXT, size INTEGER, num_modules INTEGER, major INTEGER, minor INTEGER, hotfix INTEGER, build INTEGER,
+    version TEXT, partition_name TEXT);
+CREATE TABLE IF NOT EXISTS modules (image_id INTEGER, manifest_offset INTEGER, idx INTEGER, name TEXT, hash TEXT,
+    offset INTEGER, size INTEGER, flags INTEGER, comptype INTEGER, guid TEXT, version TEXT, load_base INTEGER);
+CREATE TABLE IF NOT EXISTS layout (image_id INTEGER, offset INTEGER, size INTEGER, kind TEXT, entropy_avg REAL,
+    entropy_max REAL);
+CREATE INDEX IF NOT EXISTS layout_image ON layout (image_id, offset);
+CREATE TABLE IF NOT EXISTS errors (image_id INTEGER, offset INTEGER, name TEXT, error TEXT);
+CREATE INDEX IF NOT EXISTS errors_image ON errors (image_id);
+CREATE INDEX IF NOT EXISTS image_paths_path ON image_paths (path);
+CREATE INDEX IF NOT EXISTS regions_image ON regions (image_id);
+CREATE INDEX IF NOT EXISTS fpts_image ON fpts (image_id);
+CREATE INDEX IF NOT EXISTS fpts_flags ON fpts (effs_present, layout_type);
+CREATE INDEX IF NOT EXISTS partitions_image ON partitions (image_id);
+CREATE INDEX IF NOT EXISTS partitions_name ON partitions (name, ptype);
+CREATE INDEX IF NOT EXISTS manifests_image ON manifests (image_id, offset);
+CREATE INDEX IF NOT EXISTS manifests_version ON manifests (partition_name, major, minor, hotfix, build);
+CREATE INDEX IF NOT EXISTS manifests_date ON manifests (date);
+CREATE INDEX IF NOT EXISTS modules_image ON modules (image_id, manifest_offset);
+CREATE INDEX IF NOT EXISTS modules_name ON modules (name, version);
+CREATE INDEX IF NOT EXISTS modules_hash ON modules (hash);
+"""
+
+def store_meta(dbname, fname, f, meta):
+    # one transaction per image; identical images share one images row and
+    # its metadata, every path they were seen under is kept in image_paths
+    db = sqlite3.connect(dbname, timeout=60)
+    db.executescript(meta_schema)
+    sha1 = hashlib.sha1(f).hexdigest()
+    path = os.path.abspath(fname).decode("latin-1")
+    now = int(time.time())
+    with db:
+        row = db.execute("SELECT id FROM images WHERE sha1 = ?", (sha1,)).fetchone()
+        if row:
+            image_id = row[0]
+            for table in ["regions", "fpts", "partitions", "manifests", "modules", "layout", "errors"]:
+                db.execute("DELETE FROM %s WHERE image_id = ?" % table, (image_id,))
+            db.execute("UPDATE images SET path = ?, added = ? WHERE id = ?", (path, now, image_id))
+        else:
+            cur = db.execute("INSERT INTO images (path, sha1, size, added) VALUES (?, ?, ?, ?)",
+                (path, sha1, len(f), now))
+            image_id = cur.lastrowid
+        db.execute("INSERT OR REPLACE INTO image_paths (image_id, path, added) VALUES (?, ?, ?)", (image_id, path, now))
+        for table, rows in [("regions", meta.regions), ("fpts", meta.fpts), ("partitions", meta.partitions),
+                            ("manifests", meta.manifests), ("modules", meta.modules), ("layout", meta.layout),
+                            ("errors", meta.errors)]:
+            if not rows:
+                continue
+            cols = sorted(rows[0].keys())
+            db.executemany("INSERT INTO %s (image_id, %s) VALUES (%d, %s)" % (table, ", ".join(cols), image_id,
+                ", ".join(":" + c for c in cols)), rows)
+    db.close()
+    print "Metadata stored in %s (image id %d)" % (dbname, image_id)
+
+class KnownHashes:
+    # on-disk index of known module hashes, built with -K and used with -k:
+    #   "MEKH", version, count, Bloom filter size in bits, Bloom probes
+    #   Bloom filter bitmap
+    #   sorted 32-byte keys (20-byte SHA-1 hashes are NUL-padded)
+    # module hashes are already uniformly distributed, so the Bloom probe
+    # positions are taken directly from the key bytes
+    KEYLEN = 32
+    HDR = struct.Struct("<4sIIII")
+
+    def __init__(self, fname):
+        self.fd = open(fname, "rb")
+        self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fname = os.path.abspath(fname)
+        magic, ver, self.count, self.nbits, self.nprobes = self.HDR.unpack_from(self.mm, 0)
+        if magic != "MEKH" or ver != 1:
+            raise Exception("%s is not a known hash index" % fname)
+        self.bloom_off = self.HDR.size
+        self.keys_off = self.bloom_off + self.nbits // 8
+
+    @staticmethod
+    def probes(key, nbits, nprobes):
+        h1, h2 = struct.unpack_from("<II", key)
+        h2 |= 1
+        return [(h1 + i*h2) & (nbits-1) for i in range(nprobes)]
+
+    @classmethod
+    def build(cls, src, fname):
+        keys = set()
+        lineno = 0
+        for line in open(src):
+            lineno += 1
+            line = line.split()
+            if not line or line[0].startswith("#"):
+                continue
+            try:
+                key = line[0].decode("hex")
+            except TypeError:
+                key = None
+            # only SHA-1 and SHA-256 hashes fit the fixed-width key array
+            if key == None or len(key) not in [20, 32]:
+                raise Exception("%s:%d: expected a 40 or 64 digit hex hash, got %r" % (src, lineno, line[0]))
+            keys.add(key.ljust(cls.KEYLEN, '\0'))
+        keys = sorted(keys)
+        nbits = 64
+        while nbits < len(keys) * 10:
+            nbits *= 2
+        nprobes = 7
+        bloom = bytearray(nbits // 8)
+        for key in keys:
+            for bit in cls.probes(key, nbits, nprobes):
+                bloom[bit >> 3] |= 1 << (bit & 7)
+        out = open(fname, "wb")
+        out.write(cls.HDR.pack("MEKH", 1, len(keys), nbits, nprobes))
+        out.write(bloom)
+        out.write("".join(keys))
+        out.close()
+        print "Known hash index: %d hashes => %s" % (len(keys), fname)
+
+    def __contains__(self, key):
+        key = key.ljust(self.KEYLEN, '\0')
+        mm = self.mm
+        for bit in self.probes(key, self.nbits, self.nprobes):
+            if not ord(mm[self.bloom_off + (bit >> 3)]) & (1 << (bit & 7)):
+                return False
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            moff = self.keys_off + mid*self.KEYLEN
+            k = mm[moff:moff+self.KEYLEN]
+            if k == key:
+                return True
+            if k < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+def dump_image(fname, offset, extract, mapped=False, statename=None, walk_code=False):
+    global blockmap, incr, meta
+    # the archive gets its INDEX and end-of-archive records even if parsing fails
+    try:
+        f = open(fname, "rb").read()
+        blockmap = None
+        incr = None
+        if statename:
+            if isinstance(output, ArchiveOutput):
+                raise Exception("Incremental mode needs directory output, not an archive")
+            if not meta:
+                meta = ImageMeta()
+            options = "extract=%d map=%d known=%s offset=%X" % (extract, mapped, known and known.fname or "", offset)
+            incr = Incremental(statename, f, options, os.getcwd())
+        if mapped:
+            blockmap = BlockMap(f)
+            blockmap.pprint()
+            if meta:
+                meta.add_layout(blockmap)
+        off2 = parse_descr(f, offset, extract)
+        if off2 != -1:
+            offset = off2
+            output.enter("ME Region")
+        if f[offset:offset+8] == "\x04\x00\x00\x00\xA1\x00\x00\x00":
+            while True:
+                manif = get_struct(f, offset, MeManifestHeader)
+                manif.parse_mods(f, offset)
+                manif.pprint()
+                if extract:
+                    manif.extract(f, offset)
+                if manif.partition_end:
+                    offset += manif.partition_end
+                    print "Next partition: +%08X (%08X)" % (manif.partition_end, offset)
+                else:
+                    break
+                if f[offset:offset+8] != "\x04\x00\x00\x00\xA1\x00\x00\x00":
+                    break
+        elif f[offset:offset+8] == "\x02\x00\x00\x00\xA1\x00\x00\x00":
+            manif = get_struct(f, offset, AcManifestHeader)
+            manif.pprint()
+        else:
+            fpt = MeFptTable(f, offset)
+            fpt.pprint()
+            if extract:
+                fpt.extract(f, offset)
+            elif walk_code or statename:
+                # metadata for the database or the incremental state needs the CODE manifests
+                fpt.parse_code(f, offset)
+        if off2 != -1:
+            output.leave()
+    finally:
+        output.close()
+    if incr:
+        incr.save(meta, output.written)
+    return f
+
+def vm_size():
+    # current address space of this process in bytes, 0 if unknown
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("VmSize:"):
+                return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+class DumpRequestHandler(SocketServer.StreamRequestHandler):
+    # one JSON request per line, one JSON reply per line:
+    #   {"path": "MeImage.bin", "extract": true, "offset": "0", "outdir": "out",
+    #    "archive": "out.tar", "compress": false, "db": "fleet.db", "map": true,
+    #    "state": "host1.state"}
+    # only "path" is required; the reply carries the listing and the parsed metadata
+    def handle(self):
+        global output, meta
+        cwd = os.getcwd()
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            err = None
+            if self.server.memcap:
+                # on top of what the warm worker already maps (interpreter, -k index, ...)
+                soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+                limit = vm_size() + self.server.memcap
+                if hard != resource.RLIM_INFINITY:
+                    limit = min(limit, hard)
+                resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+            try:
+                req = json.loads(line)
+                fname = os.path.abspath(req["path"])
+                offset = req.get("offset", 0)
+                if not isinstance(offset, (int, long)):
+                    offset = int(offset, 16)
+                archive = req.get("archive")
+                if archive == "-":
+                    raise Exception("cannot stream an archive over the socket")
+                if archive:
+                    archive = os.path.abspath(archive)
+                outdir = req.get("outdir")
+                if outdir:
+                    try:
+                        os.makedirs(outdir)
+                    except:
+                        pass
+                    os.chdir(outdir)
+                output = DirOutput()
+                if archive:
+                    output = ArchiveOutput(archive, req.get("compress", False))
+                meta = ImageMeta()
+                statename = req.get("state")
+                if statename:
+                    statename = os.path.join(cwd, statename)
+                f = dump_image(fname, offset, req.get("extract", False) or bool(archive), req.get("map", False), statename,
+                    bool(req.get("db")))
+                if req.get("db"):
+                    store_meta(os.path.join(cwd, req["db"]), fname, f, meta)
+                reply = dict(ok=True, meta=meta.__dict__)
+            except Exception:
+                err = sys.exc_info()
+            # lift the cap before building the reply so it can still be sent
+            f = None
+            if self.server.memcap:
+                resource.setrlimit(resource.RLIMIT_AS, (hard, hard))
+            os.chdir(cwd)
+            listing = sys.stdout
+            sys.stdout = stdout
+            try:
+                if err and err[0] is MemoryError:
+                    reply = dict(ok=False, error="memory limit exceeded")
+                elif err:
+                    reply = dict(ok=False, error="%s: %s" % (err[0].__name__, err[1]),
+                        traceback="".join(traceback.format_exception(*err)))
+                err = None
+                # the listing prints names and tags straight from the image
+                reply["listing"] = listing.getvalue().decode("latin-1")
+                data = json.dumps(reply, encoding="latin-1")
+            except Exception, e:
+                data = json.dumps(dict(ok=False, error="%s: %s" % (e.__class__.__name__, e)), encoding="latin-1")
+            listing = reply = None
+            self.wfile.write(data + "\n")
+            self.wfile.flush()
+
+class DumpServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    # every connection is served by a forked copy of the warm process,
+    # at most max_children at a time, each under its own address space cap
+    def __init__(self, sockname, workers, memcap):
+        self.max_children = workers
+        self.memcap = memcap
+        if os.path.exists(sockname):
+            os.unlink(sockname)
+        SocketServer.UnixStreamServer.__init__(self, sockname, DumpRequestHandler)
+
+def serve(args):
+    global known
+    sockname = args.pop(0)
+    workers = 4
+    memcap = 0
+    while args:
+        opt = args.pop(0)
+        if opt == "-j":
+            workers = int(args.pop(0))
+        elif opt == "-M":
+            memcap = int(args.pop(0)) << 20
+        elif opt == "-k":
+            known = KnownHashes(args.pop(0))
+    server = DumpServer(sockname, workers, memcap)
+    print "Listening on %s (%d workers)" % (sockname, workers)
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(sockname)
+
+if len(sys.argv) > 1 and sys.argv[1] == "-K":
+    KnownHashes.build(sys.argv[2], sys.argv[3])
+elif len(sys.argv) > 1 and sys.argv[1] == "-S":
+    serve(sys.argv[2:])
+elif len(sys.argv) < 2:
+    print "Intel ME dumper/extractor v0.1"
+    print "Usage: dump_me.py MeImage.bin [-x] [-a archive] [-z] [-d db] [-k index] [-m] [-i state] [offset]"
+    print "       dump_me.py -K hashlist.txt index"
+    print "       dump_me.py -S socket [-j workers] [-M megabytes] [-k index]"
     print "   -x: extract ME partitions and code modules"
+    print "   -a: extract into a single .tar or .zip archive (\"-\" streams a tar to stdout)"
+    print "   -z: compress the archive (gzip for tar, deflate for zip)"
+    print "   -d: store FPT, manifest, module and region metadata in an SQLite database"
+    print "   -k: skip modules whose hash is in the known hash index"
+    print "   -m: print the flash layout map and skip empty (0xFF/0x00) areas"
+    print "   -i: incremental mode, only redo what changed since the run that saved this state file"
+    print "   -K: build a known hash index from a list of hex hashes, one per line"
+    print "   -S: serve JSON parse/extract requests on a Unix socket"
+    print "   -j: number of requests served concurrently (default 4)"
+    print "   -M: address space limit per request, in megabytes"
 else:
     fname = sys.argv[1]
     extract = False
+    archive = None
+    compress = False
+    dbname = None
+    mapped = False
+    statename = None
     offset = 0
-    for opt in sys.argv[2:]:
+    args = sys.argv[2:]
+    while args:
+        opt = args.pop(0)
         if opt == "-x":
             extract = True
+        elif opt == "-a":
+            archive = args.pop(0)
+            extract = True
+        elif opt == "-z":
+            compress = True
+        elif opt == "-d":
+            dbname = args.pop(0)
+            meta = ImageMeta()
+        elif opt == "-k":
+            known = KnownHashes(args.pop(0))
+        elif opt == "-m":
+            mapped = True
+        elif opt == "-i":
+            statename = os.path.abspath(args.pop(0))
         else:
             offset = int(opt, 16)
-    f = open(fname, "rb").read()
-    off2 = parse_descr(f, offset, extract)
-    if off2 != -1:
-        offset = off2
-        try:
-           os.mkdir("ME Region")
-        except:
-           pass
-        os.chdir("ME Region")
-    if f[offset:offset+8] == "\x04\x00\x00\x00\xA1\x00\x00\x00":
-        while True:
-            manif = get_struct(f, offset, MeManifestHeader)
-            manif.parse_mods(f, offset)
-            manif.pprint()
-            if extract:
-                manif.extract(f, offset)
-            if manif.partition_end:
-                offset += manif.partition_end
-                print "Next partition: +%08X (%08X)" % (manif.partition_end, offset)
-            else:
-                break
-            if f[offset:offset+8] != "\x04\x00\x00\x00\xA1\x00\x00\x00":
-                break
-    elif f[offset:offset+8] == "\x02\x00\x00\x00\xA1\x00\x00\x00":
-        manif = get_struct(f, offset, AcManifestHeader)
-        manif.pprint()
-    else:
-        fpt = MeFptTable(f, offset)
-        fpt.pprint()
-        if extract:
-            fpt.extract(f, offset)
-    if off2 != -1:
-        os.chdir("..")
+    if archive:
+        output = ArchiveOutput(archive, compress)
+        if archive == "-":
+            # keep the tar stream clean, send the listing to stderr
+            sys.stdout = sys.stderr
+    print "Intel ME dumper/extractor v0.1"
+    f = dump_image(fname, offset, extract, mapped, statename, dbname != None)
+    if dbname:
+        store_meta(dbname, fname, f, meta)